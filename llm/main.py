@@ -4,7 +4,9 @@
 import os
 import sys
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
+import yaml
 from composer import Trainer
 from composer.utils import dist, reproducibility
 from omegaconf import OmegaConf as om
@@ -12,17 +14,41 @@ from src.model_registry import COMPOSER_MODEL_REGISTRY
 
 from mosaicml_examples.builders import (build_algorithm, build_callback,
                                         build_dataloader, build_logger,
-                                        build_optimizer, build_scheduler)
+                                        build_optimizer,
+                                        build_per_layer_optimizer,
+                                        build_scheduler)
 from mosaicml_examples.logging_utils import log_config
 
+warnings.filterwarnings(
+    action='ignore',
+    message='Torchmetrics v0.9 introduced a new argument class property')
+
+# `_CYamlLoader` behaves like OmegaConf's yaml loader (e.g. `2e8` parses as a
+# float and duplicate keys raise) but parses with the libyaml C parser. It
+# relies on a private OmegaConf helper, so `load_yaml_cfg` falls back to
+# `om.load` if that helper or libyaml is unavailable.
+try:
+    from omegaconf._utils import get_yaml_loader
+
+    class _CYamlLoader(yaml.cyaml.CParser, get_yaml_loader()):
+
+        def __init__(self, stream):
+            yaml.cyaml.CParser.__init__(self, stream)
+            yaml.constructor.SafeConstructor.__init__(self)
+            yaml.resolver.Resolver.__init__(self)
+
+except (ImportError, AttributeError):
+    _CYamlLoader = None
+
 
 def calculate_batch_size_info(global_batch_size, device_microbatch_size):
-    if global_batch_size % dist.get_world_size() != 0:
+    world_size = dist.get_world_size()
+    if global_batch_size % world_size != 0:
         raise ValueError(
-            f'Global batch size {global_batch_size} is not divisible by {dist.get_world_size()} '
+            f'Global batch size {global_batch_size} is not divisible by {world_size} '
             'as a result, the batch size would be truncated, please adjust `global_batch_size` '
-            f'to be divisible by world size, {dist.get_world_size()}.')
-    device_batch_size = global_batch_size // dist.get_world_size()
+            f'to be divisible by world size, {world_size}.')
+    device_batch_size = global_batch_size // world_size
     if device_microbatch_size == 'auto':
         device_grad_accum = 'auto'
     elif isinstance(device_microbatch_size, int):
@@ -57,13 +83,18 @@ def update_batch_size_info(cfg):
 
 
 def build_composer_model(cfg):
-    warnings.filterwarnings(
-        action='ignore',
-        message='Torchmetrics v0.9 introduced a new argument class property')
-    try:
-        return COMPOSER_MODEL_REGISTRY[cfg.name](cfg)
-    except:
+    if cfg.name not in COMPOSER_MODEL_REGISTRY:
         raise ValueError(f'Not sure how to build model with name={cfg.name}')
+    return COMPOSER_MODEL_REGISTRY[cfg.name](cfg)
+
+
+def load_yaml_cfg(yaml_path):
+    """Same as `om.load`, but parses with the libyaml C parser if available."""
+    with open(yaml_path) as f:
+        if _CYamlLoader is None:
+            return om.load(f)
+        # like `om.load`, an empty yaml gives an empty config rather than None
+        return om.create(yaml.load(f, Loader=_CYamlLoader) or {})
 
 
 def main(cfg):
@@ -81,6 +112,16 @@ def main(cfg):
     fsdp_config = om.to_container(fsdp_config,
                                   resolve=True) if fsdp_config else None
 
+    # When training in bf16 without an explicit FSDP `mixed_precision`, run
+    # the FSDP all-gathers and reduce-scatters in bf16 as well, halving the
+    # bytes on the wire vs. fp32 collectives.
+    if fsdp_config is not None and cfg.precision == 'amp_bf16':
+        fsdp_config.setdefault('mixed_precision', {
+            'param_dtype': 'bf16',
+            'reduce_dtype': 'bf16',
+            'buffer_dtype': 'bf16',
+        })
+
     # Restrict model init device to 'meta' and 'cpu',
     # using 'cuda' vs. 'cuda:id' is tricky and can lead to common user errors
     # when multiple GPUs are available.
@@ -92,24 +133,47 @@ def main(cfg):
             "Reverting to `cfg.model.device='cpu'`.")
         cfg.model.device = 'cpu'
 
-    # Build Model
+    # Build Model and Dataloaders
+    # The model build does not depend on the dataloaders, so build the
+    # dataloaders on a background thread while the model is initialized on the
+    # main thread. The two dataloaders are built one after the other on a
+    # single thread: each StreamingTextDataset issues a job-wide barrier in its
+    # __init__, and building them concurrently could pair one rank's train
+    # barrier with another rank's eval barrier.
     # For fast initialization of MosaicGPT, use cfg.model.device='meta'
-    print('Initializing model...')
-    model = build_composer_model(cfg.model)
-    cfg.n_params = sum(p.numel() for p in model.parameters())
-    print(f'{cfg.n_params=:.2e}')
-    if hasattr(model, 'num_fwd_flops'):
-        print(f'{model.num_fwd_flops=:.2e}')
-
-    # Dataloaders
-    print('Building train loader...')
-    train_loader = build_dataloader(cfg.train_loader,
-                                    cfg.device_train_batch_size)
-    print('Building eval loader...')
-    eval_loader = build_dataloader(cfg.eval_loader, cfg.device_eval_batch_size)
+    def build_dataloaders():
+        print('Building train loader...')
+        train_loader = build_dataloader(cfg.train_loader,
+                                        cfg.device_train_batch_size)
+        print('Building eval loader...')
+        eval_loader = build_dataloader(cfg.eval_loader,
+                                       cfg.device_eval_batch_size)
+        return train_loader, eval_loader
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        dataloaders_future = executor.submit(build_dataloaders)
+        print('Initializing model...')
+        model = build_composer_model(cfg.model)
+        train_loader, eval_loader = dataloaders_future.result()
+
+    # The model is not sharded yet, so every rank would count the same number
+    # of params; only rank 0 logs the config so only it needs the count
+    if dist.get_global_rank() == 0:
+        cfg.n_params = sum(p.numel() for p in model.parameters())
+        print(f'{cfg.n_params=:.2e}')
+        if hasattr(model, 'num_fwd_flops'):
+            print(f'{model.num_fwd_flops=:.2e}')
 
     # Optimizer
-    optimizer = build_optimizer(cfg.optimizer, model)
+    # With FSDP, optionally keep optimizer states on CPU and stream them to GPU
+    # one FSDP unit at a time during the step to bound optimizer memory
+    if cfg.optimizer.get('per_layer_optim_step', False):
+        if fsdp_config is None:
+            raise ValueError(
+                '`optimizer.per_layer_optim_step` requires an `fsdp_config`.')
+        optimizer = build_per_layer_optimizer(cfg.optimizer, model)
+    else:
+        optimizer = build_optimizer(cfg.optimizer, model)
 
     # Scheduler
     scheduler = build_scheduler(cfg.scheduler)
@@ -117,19 +181,19 @@ def main(cfg):
     # Loggers
     loggers = [
         build_logger(name, logger_cfg)
-        for name, logger_cfg in cfg.get('loggers', {}).items()
+        for name, logger_cfg in (cfg.get('loggers') or {}).items()
     ]
 
     # Callbacks
     callbacks = [
         build_callback(name, callback_cfg)
-        for name, callback_cfg in cfg.get('callbacks', {}).items()
+        for name, callback_cfg in (cfg.get('callbacks') or {}).items()
     ]
 
     # Algorithms
     algorithms = [
         build_algorithm(name, algorithm_cfg)
-        for name, algorithm_cfg in cfg.get('algorithms', {}).items()
+        for name, algorithm_cfg in (cfg.get('algorithms') or {}).items()
     ]
 
     # Build the Trainer
@@ -173,8 +237,7 @@ def main(cfg):
 
 if __name__ == '__main__':
     yaml_path, args_list = sys.argv[1], sys.argv[2:]
-    with open(yaml_path) as f:
-        yaml_cfg = om.load(f)
+    yaml_cfg = load_yaml_cfg(yaml_path)
     cli_cfg = om.from_cli(args_list)
     cfg = om.merge(yaml_cfg, cli_cfg)
     main(cfg)
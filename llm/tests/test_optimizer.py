@@ -0,0 +1,132 @@
+# Copyright 2022 MosaicML Examples authors
+# SPDX-License-Identifier: Apache-2.0
+
+import copy
+import io
+
+import pytest
+import torch
+import torch.nn as nn
+from composer.optim import DecoupledAdamW
+from omegaconf import OmegaConf as om
+
+from mosaicml_examples.builders import (build_optimizer,
+                                        build_per_layer_optimizer)
+
+
+def get_model():
+    torch.manual_seed(17)
+    return nn.Sequential(nn.Linear(8, 16), nn.ReLU(), nn.Linear(16, 4))
+
+
+def get_optimizer_cfg(name='decoupled_adamw', **kwargs):
+    return om.create({
+        'name': name,
+        'lr': 1.0e-2,
+        'betas': [0.9, 0.95],
+        'eps': 1.0e-8,
+        'weight_decay': 1.0e-3,
+        **kwargs,
+    })
+
+
+def assert_close_to_decoupled_adamw(model, optimizer, n_steps=5):
+    ref_model = copy.deepcopy(model)
+    ref_optimizer = DecoupledAdamW(ref_model.parameters(),
+                                   lr=1.0e-2,
+                                   betas=(0.9, 0.95),
+                                   eps=1.0e-8,
+                                   weight_decay=1.0e-3)
+    for step in range(n_steps):
+        x = torch.randn(4, 8, device=next(model.parameters()).device)
+        for m, o in ((model, optimizer), (ref_model, ref_optimizer)):
+            # decay the lr so weight decay has to follow lr / initial_lr
+            for group in o.param_groups:
+                group['lr'] = 1.0e-2 * 0.5**step
+            o.zero_grad()
+            m(x).square().sum().backward()
+            o.step()
+        for p, ref_p in zip(model.parameters(), ref_model.parameters()):
+            torch.testing.assert_close(p, ref_p)
+
+
+def test_foreach_adamw_matches_decoupled_adamw():
+    model = get_model()
+    optimizer = build_optimizer(
+        get_optimizer_cfg(name='decoupled_adamw_foreach'), model)
+    assert isinstance(optimizer, torch.optim.AdamW)
+    assert_close_to_decoupled_adamw(model, optimizer)
+
+
+def test_foreach_adamw_zero_lr():
+    with pytest.raises(ValueError):
+        build_optimizer(
+            get_optimizer_cfg(name='decoupled_adamw_foreach', lr=0.0),
+            get_model())
+
+
+DEVICES = [
+    'cpu',
+    pytest.param('cuda',
+                 marks=pytest.mark.skipif(
+                     not torch.cuda.is_available(),
+                     reason='testing with cuda requires GPU')),
+]
+
+
+@pytest.mark.parametrize('device', DEVICES)
+def test_per_layer_optimizer_matches_decoupled_adamw(device):
+    model = get_model().to(device)
+    optimizer = build_per_layer_optimizer(get_optimizer_cfg(), model)
+    assert_close_to_decoupled_adamw(model, optimizer)
+
+
+@pytest.mark.parametrize('device', DEVICES)
+def test_per_layer_optimizer_state_dict_round_trip(device):
+    model = get_model().to(device)
+    optimizer = build_per_layer_optimizer(get_optimizer_cfg(), model)
+    x = torch.randn(4, 8, device=device)
+    for _ in range(3):
+        optimizer.zero_grad()
+        model(x).square().sum().backward()
+        optimizer.step()
+
+    f = io.BytesIO()
+    torch.save(optimizer.state_dict(), f)
+    f.seek(0)
+    loaded_model = copy.deepcopy(model)
+    loaded_optimizer = build_per_layer_optimizer(get_optimizer_cfg(),
+                                                 loaded_model)
+    loaded_optimizer.load_state_dict(torch.load(f))
+
+    for m, o in ((model, optimizer), (loaded_model, loaded_optimizer)):
+        o.zero_grad()
+        m(x).square().sum().backward()
+        o.step()
+    for p, loaded_p in zip(model.parameters(), loaded_model.parameters()):
+        torch.testing.assert_close(p, loaded_p)
+    for state in loaded_optimizer.state.values():
+        assert not state['exp_avg'].is_cuda
+        assert not state['exp_avg_sq'].is_cuda
+
+
+def per_layer_step_peak_memory(n_layers):
+    model = nn.Sequential(*[nn.Linear(1024, 1024) for _ in range(n_layers)])
+    model = model.cuda()
+    optimizer = build_per_layer_optimizer(
+        get_optimizer_cfg(optim_step_prefetch_layers=1), model)
+    model(torch.randn(4, 1024, device='cuda')).square().sum().backward()
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    baseline = torch.cuda.memory_allocated()
+    optimizer.step()
+    torch.cuda.synchronize()
+    return torch.cuda.max_memory_allocated() - baseline
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(),
+                    reason='testing with cuda requires GPU')
+def test_per_layer_optimizer_memory_is_bounded():
+    # with prefetch_layers=1 at most 2 layers' states are on GPU at a time,
+    # whereas keeping every layer's states would need 8x more for 32 layers
+    assert per_layer_step_peak_memory(32) < 2 * per_layer_step_peak_memory(4)
@@ -0,0 +1,34 @@
+# Copyright 2022 MosaicML Examples authors
+# SPDX-License-Identifier: Apache-2.0
+
+import glob
+
+import pytest
+from main import load_yaml_cfg
+from omegaconf import OmegaConf as om
+
+CONF_PATHS = sorted(
+    glob.glob('yamls/**/*.yaml', recursive=True) + glob.glob('mcloud/*.yaml'))
+
+
+@pytest.mark.parametrize('conf_path', CONF_PATHS)
+def test_load_yaml_cfg_matches_om_load(conf_path):
+    with open(conf_path) as f:
+        expected = om.load(f)
+    actual = load_yaml_cfg(conf_path)
+    assert om.to_container(actual) == om.to_container(expected)
+    # types matter too, e.g. `min_params: 2e8` must stay a float
+    assert om.to_yaml(actual) == om.to_yaml(expected)
+
+
+def test_load_yaml_cfg_duplicate_keys(tmp_path):
+    conf_path = tmp_path / 'duplicate.yaml'
+    conf_path.write_text('a: 1\na: 2\n')
+    with pytest.raises(Exception, match='duplicate key'):
+        load_yaml_cfg(str(conf_path))
+
+
+def test_load_yaml_cfg_empty(tmp_path):
+    conf_path = tmp_path / 'empty.yaml'
+    conf_path.write_text('')
+    assert om.to_container(load_yaml_cfg(str(conf_path))) == {}
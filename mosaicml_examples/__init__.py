@@ -3,7 +3,8 @@
 
 __version__ = '0.0.1'
 
-from . import builders, logging_utils, speed_monitor_w_mfu, text_data
+from . import (builders, logging_utils, per_layer_optimizer,
+               speed_monitor_w_mfu, text_data)
 
 __all__ = [
     '__version__',
@@ -11,4 +12,5 @@ __all__ = [
     'text_data',
     'speed_monitor_w_mfu',
     'logging_utils',
+    'per_layer_optimizer',
 ]
@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import composer
+import torch
 from composer import algorithms
 from composer.callbacks import LRMonitor, MemoryMonitor, SpeedMonitor
 from composer.loggers import WandBLogger
@@ -11,50 +12,66 @@ from composer.optim.scheduler import (ConstantWithWarmupScheduler,
                                       LinearWithWarmupScheduler)
 from packaging import version
 
+from mosaicml_examples.per_layer_optimizer import PerLayerOptimWrapper
 from mosaicml_examples.speed_monitor_w_mfu import SpeedMonitorMFU
 from mosaicml_examples.text_data import build_text_dataloader
 
 
+def _build_speed_monitor(kwargs):
+    if version.parse(composer.__version__) < version.parse('0.12.0'):
+        return SpeedMonitor(window_size=kwargs.get('window_size', 1))
+    return SpeedMonitorMFU(window_size=kwargs.get('window_size', 1),
+                           gpu_flops_available=kwargs.get(
+                               'gpu_flops_available', None))
+
+
+def _build_optimizer_monitor(kwargs):
+    try:
+        from composer.callbacks import OptimizerMonitor
+    except ImportError:
+        raise ValueError('Not sure how to build callback: optimizer_monitor')
+    return OptimizerMonitor(log_optimizer_metrics=kwargs.get(
+        'log_optimizer_metrics', True),)
+
+
+_CALLBACKS = {
+    'lr_monitor': lambda kwargs: LRMonitor(),
+    'memory_monitor': lambda kwargs: MemoryMonitor(),
+    'speed_monitor': _build_speed_monitor,
+    'optimizer_monitor': _build_optimizer_monitor,
+}
+
+_LOGGERS = {
+    'wandb': lambda kwargs: WandBLogger(**kwargs),
+}
+
+_ALGORITHMS = {
+    'gradient_clipping': lambda kwargs: algorithms.GradientClipping(**kwargs),
+    'alibi': lambda kwargs: algorithms.Alibi(**kwargs),
+    'fused_layernorm': lambda kwargs: algorithms.FusedLayerNorm(**kwargs),
+    'gated_linear_units': lambda kwargs: algorithms.GatedLinearUnits(**kwargs),
+}
+
+
 def build_callback(name, kwargs):
-    if name == 'lr_monitor':
-        return LRMonitor()
-    elif name == 'memory_monitor':
-        return MemoryMonitor()
-    elif name == 'speed_monitor':
-        if version.parse(composer.__version__) < version.parse('0.12.0'):
-            return SpeedMonitor(window_size=kwargs.get('window_size', 1))
-        return SpeedMonitorMFU(window_size=kwargs.get('window_size', 1),
-                               gpu_flops_available=kwargs.get(
-                                   'gpu_flops_available', None))
-    elif name == 'optimizer_monitor':
-        try:
-            from composer.callbacks import OptimizerMonitor
-            return OptimizerMonitor(log_optimizer_metrics=kwargs.get(
-                'log_optimizer_metrics', True),)
-        except:
-            raise ValueError(f'Not sure how to build callback: {name}')
-    else:
+    build_fn = _CALLBACKS.get(name)
+    if build_fn is None:
         raise ValueError(f'Not sure how to build callback: {name}')
+    return build_fn(kwargs)
 
 
 def build_logger(name, kwargs):
-    if name == 'wandb':
-        return WandBLogger(**kwargs)
-    else:
+    build_fn = _LOGGERS.get(name)
+    if build_fn is None:
         raise ValueError(f'Not sure how to build logger: {name}')
+    return build_fn(kwargs)
 
 
 def build_algorithm(name, kwargs):
-    if name == 'gradient_clipping':
-        return algorithms.GradientClipping(**kwargs)
-    elif name == 'alibi':
-        return algorithms.Alibi(**kwargs)
-    elif name == 'fused_layernorm':
-        return algorithms.FusedLayerNorm(**kwargs)
-    elif name == 'gated_linear_units':
-        return algorithms.GatedLinearUnits(**kwargs)
-    else:
+    build_fn = _ALGORITHMS.get(name)
+    if build_fn is None:
         raise ValueError(f'Not sure how to build algorithm: {name}')
+    return build_fn(kwargs)
 
 
 def build_optimizer(cfg, model):
@@ -64,10 +81,44 @@ def build_optimizer(cfg, model):
                               betas=cfg.betas,
                               eps=cfg.eps,
                               weight_decay=cfg.weight_decay)
+    elif cfg.name == 'decoupled_adamw_foreach':
+        return build_foreach_adamw(cfg, model)
     else:
         raise ValueError(f'Not sure how to build optimizer: {cfg.name}')
 
 
+def build_foreach_adamw(cfg, model):
+    # torch.optim.AdamW scales weight decay by the current lr, whereas
+    # DecoupledAdamW scales it by lr / initial_lr. Dividing by the initial lr
+    # keeps the decoupled weight decay semantics of `decoupled_adamw`.
+    if cfg.weight_decay != 0 and cfg.lr == 0:
+        raise ValueError(
+            'Decoupled weight decay with foreach AdamW requires a non-zero lr.')
+    weight_decay = cfg.weight_decay / cfg.lr if cfg.weight_decay != 0 else 0.0
+    return torch.optim.AdamW(model.parameters(),
+                             lr=cfg.lr,
+                             betas=tuple(cfg.betas),
+                             eps=cfg.eps,
+                             weight_decay=weight_decay,
+                             foreach=True,
+                             capturable=cfg.get('capturable', False))
+
+
+def build_per_layer_optimizer(cfg, model):
+    if cfg.name != 'decoupled_adamw':
+        raise ValueError(
+            f'per_layer_optim_step is only supported with decoupled_adamw, got: {cfg.name}'
+        )
+    return PerLayerOptimWrapper(model.parameters(),
+                                model,
+                                lr=cfg.lr,
+                                betas=cfg.betas,
+                                eps=cfg.eps,
+                                weight_decay=cfg.weight_decay,
+                                prefetch_layers=cfg.get(
+                                    'optim_step_prefetch_layers', 2))
+
+
 def build_scheduler(cfg):
     if cfg.name == 'constant_with_warmup':
         return ConstantWithWarmupScheduler(t_warmup=cfg.t_warmup)
@@ -81,8 +132,13 @@ def build_scheduler(cfg):
         raise ValueError(f'Not sure how to build scheduler: {cfg.name}')
 
 
+_DATALOADERS = {
+    'text': build_text_dataloader,
+}
+
+
 def build_dataloader(cfg, device_batch_size):
-    if cfg.name == 'text':
-        return build_text_dataloader(cfg, device_batch_size)
-    else:
+    build_fn = _DATALOADERS.get(cfg.name)
+    if build_fn is None:
         raise ValueError(f'Not sure how to build dataloader with config: {cfg}')
+    return build_fn(cfg, device_batch_size)
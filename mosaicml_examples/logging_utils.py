@@ -1,15 +1,23 @@
 # Copyright 2022 MosaicML Examples authors
 # SPDX-License-Identifier: Apache-2.0
 
+from composer.utils import dist
 from omegaconf import OmegaConf as om
 
+try:
+    import wandb
+except ImportError:
+    wandb = None
+
 
 def log_config(cfg):
+    # Only rank 0 prints the config and logs it to wandb
+    if dist.get_global_rank() != 0:
+        return
     print(om.to_yaml(cfg))
-    if 'wandb' in cfg.get('loggers', {}):
-        try:
-            import wandb
-        except ImportError as e:
-            raise e
+    if 'wandb' in (cfg.get('loggers') or {}):
+        if wandb is None:
+            raise ImportError(
+                'wandb must be installed to log the config to wandb.')
         if wandb.run:
             wandb.config.update(om.to_container(cfg, resolve=True))
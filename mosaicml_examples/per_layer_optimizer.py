@@ -0,0 +1,278 @@
+# Copyright 2022 MosaicML Examples authors
+# SPDX-License-Identifier: Apache-2.0
+
+"""AdamW that keeps its states on CPU and streams them to GPU layer by layer."""
+
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from torch.distributed.fsdp import FullyShardedDataParallel
+from torch.optim import Optimizer
+from torch.optim.adamw import adamw
+
+
+class PerLayerOptimWrapper(Optimizer):
+    """Decoupled AdamW whose optimizer states live in pinned CPU memory.
+
+    Instead of materializing ``exp_avg`` and ``exp_avg_sq`` for every parameter
+    on GPU (~8 bytes/param for fp32 states), the step is performed one FSDP
+    unit at a time. For each unit, the states are copied host-to-device on a
+    dedicated stream, updated with the multi-tensor AdamW kernel on the compute
+    stream, and copied back device-to-host on a third stream. CUDA events let
+    the host-to-device copies run ``prefetch_layers`` units ahead of compute,
+    and before prefetching another unit the host waits for the copy back of
+    the unit ``prefetch_layers`` behind the current one, so at most
+    ``2 * prefetch_layers`` units' states are on GPU at a time rather than
+    the whole model's.
+
+    Parameters themselves stay wherever FSDP put them; only the optimizer
+    states are offloaded. Weight decay follows the ``DecoupledAdamW``
+    convention of scaling by ``lr / initial_lr``.
+
+    Args:
+        params (iterable): Parameters to optimize.
+        model (torch.nn.Module): The model owning ``params``. Its
+            ``FullyShardedDataParallel`` submodules define the layers the step
+            is streamed over. If it contains none, each top-level child module
+            is treated as a layer.
+        lr (float): Learning rate. Defaults to ``1e-3``.
+        betas (Tuple[float, float]): Coefficients for the running averages of
+            the gradient and its square. Defaults to ``(0.9, 0.95)``.
+        eps (float): Term added to the denominator for numerical stability.
+            Defaults to ``1e-8``.
+        weight_decay (float): Decoupled weight decay. Defaults to ``0.0``.
+        prefetch_layers (int): How many layers ahead of the one being updated
+            to copy states host-to-device. Defaults to ``2``.
+    """
+
+    def __init__(self,
+                 params,
+                 model: torch.nn.Module,
+                 lr: float = 1e-3,
+                 betas: Tuple[float, float] = (0.9, 0.95),
+                 eps: float = 1e-8,
+                 weight_decay: float = 0.0,
+                 prefetch_layers: int = 2):
+        if prefetch_layers < 1:
+            raise ValueError(
+                f'prefetch_layers={prefetch_layers} must be at least 1.')
+        # `initial_lr` lives in the defaults so that param groups re-added by
+        # Composer when wrapping the model with FSDP pick it up as well.
+        defaults = dict(lr=lr,
+                        initial_lr=lr,
+                        betas=tuple(betas),
+                        eps=eps,
+                        weight_decay=weight_decay)
+        super().__init__(params, defaults)
+        self.model = model
+        self.prefetch_layers = prefetch_layers
+        self._group_of: Dict[torch.nn.Parameter, int] = {}
+        self._h2d_stream: Optional[torch.cuda.Stream] = None
+        self._d2h_stream: Optional[torch.cuda.Stream] = None
+
+    def state_dict(self):
+        """Returns the state dict, with the states on GPU under FSDP.
+
+        Under FSDP, Composer saves the optimizer state via
+        ``FSDP.full_optim_state_dict``, which gathers it with collectives that
+        need the states on the same (CUDA) device as the params. While saving,
+        this needs as much GPU memory as a regular optimizer would hold for the
+        states of this rank's shards, so a ``RuntimeError`` is raised before
+        moving anything if that much is not free. Without FSDP the states are
+        returned on CPU.
+        """
+        state_dict = super().state_dict()
+        if not any(
+                isinstance(m, FullyShardedDataParallel)
+                for m in self.model.modules()):
+            return state_dict
+        params = [p for group in self.param_groups for p in group['params']]
+        cuda_idxs = [i for i in state_dict['state'] if params[i].is_cuda]
+        if not cuda_idxs:
+            return state_dict
+
+        device = params[cuda_idxs[0]].device
+        needed = sum(v.numel() * v.element_size()
+                     for i in cuda_idxs
+                     for k, v in state_dict['state'][i].items()
+                     if k != 'step')
+        free, _ = torch.cuda.mem_get_info(device)
+        free += (torch.cuda.memory_reserved(device) -
+                 torch.cuda.memory_allocated(device))
+        if needed > free:
+            raise RuntimeError(
+                f'Saving the optimizer state needs {needed / 2**30:.2f} GiB '
+                f'of GPU memory on {device}, but only {free / 2**30:.2f} GiB '
+                'is free.')
+        for i in cuda_idxs:
+            state_dict['state'][i] = {
+                k: v if k == 'step' else v.to(device)
+                for k, v in state_dict['state'][i].items()
+            }
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        # Optimizer.load_state_dict would cast every state to its param's
+        # device at once, so only load the param groups through it and copy
+        # the states straight to (pinned) CPU memory
+        super().load_state_dict({**state_dict, 'state': {}})
+        saved_ids = (i for g in state_dict['param_groups'] for i in g['params'])
+        params = (p for g in self.param_groups for p in g['params'])
+        id_map = dict(zip(saved_ids, params))
+        for i, saved_state in state_dict['state'].items():
+            p = id_map[i]
+            state = {}
+            for k, v in saved_state.items():
+                if k == 'step':
+                    state[k] = torch.tensor(float(v))
+                else:
+                    v = v.to('cpu', p.dtype)
+                    state[k] = v.pin_memory() if p.is_cuda else v.clone()
+            self.state[p] = state
+
+    def _layers(self) -> List[List[torch.nn.Parameter]]:
+        """Groups the params with grads by the innermost unit that owns them."""
+        model = self.model
+        units = [
+            m for m in model.modules()
+            if isinstance(m, FullyShardedDataParallel)
+        ]
+        if not units:
+            units = list(model.children())
+        # modules() is pre-order, so nested units overwrite their parents
+        owner = {}
+        for i, unit in enumerate(units):
+            for p in unit.parameters():
+                owner[p] = i
+        layers: Dict[int, List[torch.nn.Parameter]] = {}
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is not None:
+                    layers.setdefault(owner.get(p, len(units)), []).append(p)
+        return [layers[i] for i in sorted(layers)]
+
+    def _init_state(self, p: torch.nn.Parameter) -> Dict[str, torch.Tensor]:
+        state = self.state[p]
+        if len(state) == 0:
+            pin = p.is_cuda
+            state['step'] = torch.tensor(0.)
+            state['exp_avg'] = torch.zeros(p.shape,
+                                           dtype=p.dtype,
+                                           pin_memory=pin)
+            state['exp_avg_sq'] = torch.zeros(p.shape,
+                                              dtype=p.dtype,
+                                              pin_memory=pin)
+        return state
+
+    def _update(self, params: List[torch.nn.Parameter],
+                exp_avgs: List[torch.Tensor], exp_avg_sqs: List[torch.Tensor]):
+        # params in a layer may belong to different param groups
+        by_group: Dict[int, Tuple[list, list, list, list]] = {}
+        group_of = self._group_of
+        for p, m, v in zip(params, exp_avgs, exp_avg_sqs):
+            g = by_group.setdefault(group_of[p], ([], [], [], []))
+            g[0].append(p)
+            g[1].append(m)
+            g[2].append(v)
+            g[3].append(self.state[p]['step'])
+        for gi, (ps, ms, vs, steps) in by_group.items():
+            group = self.param_groups[gi]
+            beta1, beta2 = group['betas']
+            lr = group['lr']
+            adamw(ps, [p.grad for p in ps],
+                  ms,
+                  vs, [],
+                  steps,
+                  foreach=ps[0].is_cuda,
+                  amsgrad=False,
+                  beta1=beta1,
+                  beta2=beta2,
+                  lr=lr,
+                  weight_decay=group['weight_decay'] / group['initial_lr'],
+                  eps=group['eps'],
+                  maximize=False)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        self._group_of = {
+            p: gi for gi, group in enumerate(self.param_groups)
+            for p in group['params']
+        }
+        layers = self._layers()
+        if not layers:
+            return loss
+
+        if not layers[0][0].is_cuda:
+            for params in layers:
+                states = [self._init_state(p) for p in params]
+                self._update(params, [s['exp_avg'] for s in states],
+                             [s['exp_avg_sq'] for s in states])
+            return loss
+
+        if self._h2d_stream is None:
+            self._h2d_stream = torch.cuda.Stream()
+            self._d2h_stream = torch.cuda.Stream()
+        h2d_stream, d2h_stream = self._h2d_stream, self._d2h_stream
+        assert d2h_stream is not None
+        compute_stream = torch.cuda.current_stream()
+        # the previous step's device-to-host copies must land before reuse
+        h2d_stream.wait_stream(d2h_stream)
+
+        prefetched = {}
+        d2h_done: List[torch.cuda.Event] = []
+
+        def prefetch(i):
+            if i >= len(layers):
+                return
+            states = [self._init_state(p) for p in layers[i]]
+            with torch.cuda.stream(h2d_stream):
+                device = layers[i][0].device
+                exp_avgs = [
+                    s['exp_avg'].to(device, non_blocking=True) for s in states
+                ]
+                exp_avg_sqs = [
+                    s['exp_avg_sq'].to(device, non_blocking=True)
+                    for s in states
+                ]
+                event = torch.cuda.Event()
+                event.record(h2d_stream)
+            prefetched[i] = (states, exp_avgs, exp_avg_sqs, event)
+
+        for i in range(self.prefetch_layers):
+            prefetch(i)
+
+        for i, params in enumerate(layers):
+            states, exp_avgs, exp_avg_sqs, h2d_done = prefetched.pop(i)
+            compute_stream.wait_event(h2d_done)
+            self._update(params, exp_avgs, exp_avg_sqs)
+            update_done = torch.cuda.Event()
+            update_done.record(compute_stream)
+
+            with torch.cuda.stream(d2h_stream):
+                d2h_stream.wait_event(update_done)
+                for s, m, v in zip(states, exp_avgs, exp_avg_sqs):
+                    s['exp_avg'].copy_(m, non_blocking=True)
+                    s['exp_avg_sq'].copy_(v, non_blocking=True)
+                    # device copies were allocated on the h2d stream, keep the
+                    # caching allocator from reusing them while still in use
+                    for t in (m, v):
+                        t.record_stream(compute_stream)
+                        t.record_stream(d2h_stream)
+
+            d2h_done.append(torch.cuda.Event())
+            d2h_done[i].record(d2h_stream)
+
+            # bound how far the host runs ahead: the device buffers of a unit
+            # can only be reused once its states have been copied back
+            if i >= self.prefetch_layers:
+                d2h_done[i - self.prefetch_layers].synchronize()
+            prefetch(i + self.prefetch_layers)
+
+        # states on CPU must be up to date before e.g. checkpointing
+        d2h_stream.synchronize()
+        return loss
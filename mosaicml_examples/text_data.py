@@ -5,10 +5,12 @@
 
 import os
 import sys
+import warnings
 from itertools import islice
 from typing import Any, Dict, Iterator, Optional
 
 import transformers
+from composer.utils import dist
 from omegaconf import DictConfig
 from omegaconf import OmegaConf as om
 from streaming import StreamingDataset
@@ -186,16 +188,34 @@ def build_text_dataloader(cfg: DictConfig, device_batch_size: int):
         mlm=mlm_probability is not None,
         mlm_probability=mlm_probability)
 
+    # Prefetch a few batches per worker into pinned memory so H2D copies
+    # overlap compute. `persistent_workers: true` (set for the train loaders
+    # in the yamls) keeps workers alive across epochs. These options are only
+    # valid with worker processes.
+    num_workers = cfg.get(
+        'num_workers',
+        min(8, (os.cpu_count() or 1) // dist.get_local_world_size()))
+    worker_kwargs = {}
+    if num_workers > 0:
+        prefetch_factor = cfg.get('prefetch_factor', 2)
+        # large prefetch factors hold many batches per worker in host memory
+        if prefetch_factor > 4:
+            warnings.warn(f'prefetch_factor={prefetch_factor} may use a lot '
+                          'of host memory, reducing it to 4.')
+            prefetch_factor = 4
+        worker_kwargs['prefetch_factor'] = prefetch_factor
+        worker_kwargs['persistent_workers'] = cfg.get('persistent_workers',
+                                                      False)
+
     return DataLoader(
         dataset,
         collate_fn=collate_fn,
         batch_size=device_batch_size,
         drop_last=cfg.drop_last,
-        num_workers=cfg.num_workers,
+        num_workers=num_workers,
         pin_memory=cfg.get('pin_memory', True),
-        prefetch_factor=cfg.get('prefetch_factor', 2),
-        persistent_workers=cfg.get('persistent_workers', False),
         timeout=cfg.get('timeout', 0),
+        **worker_kwargs,
     )
 
 